@@ -55,6 +55,16 @@ _C.DETERMINISM = False
 # Precision
 _C.MIXED_PRECISION = False
 
+# Compile the hot loss functions of supported methods with torch.compile
+_C.COMPILE = False
+
+# Replay captured CUDA graphs for the static inference forwards of supported methods
+_C.CUDA_GRAPH = False
+
+# Forward the original and augmented test data of supported methods in a single batched pass.
+# Since batch norm then uses the statistics of both views, this changes the predictions and results
+_C.BATCH_AUG_VIEWS = False
+
 # Optional description of a config
 _C.DESC = ""
 
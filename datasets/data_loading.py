@@ -238,7 +238,8 @@ def get_test_loader(setting: str, adaptation: str, dataset_name: str, preprocess
 def get_source_loader(dataset_name: str, adaptation: str, preprocess: Union[transforms.Compose, None],
                       data_root_dir: str, batch_size: int, use_clip: bool, n_views: int = 64,
                       train_split: bool = True, ckpt_path: str = None, num_samples: int = -1,
-                      percentage: float = 1.0, workers: int = 4):
+                      percentage: float = 1.0, workers: int = 4, pin_memory: bool = False,
+                      persistent_workers: bool = False):
     """
     Create the source data loader
     Input:
@@ -254,6 +255,8 @@ def get_source_loader(dataset_name: str, adaptation: str, preprocess: Union[tran
         num_samples: Number of source samples used during training
         percentage: (0, 1] Percentage of source samples used during training
         workers: Number of workers used for data loading
+        pin_memory: Whether to place batches in page-locked memory. Required for non-blocking host-to-device copies
+        persistent_workers: Whether to keep the worker processes alive when the loader is re-iterated
     Returns:
         source_dataset: The source dataset
         source_loader: The source data loader
@@ -321,11 +324,53 @@ def get_source_loader(dataset_name: str, adaptation: str, preprocess: Union[tran
                                                 batch_size=batch_size,
                                                 shuffle=True,
                                                 num_workers=workers,
+                                                pin_memory=pin_memory,
+                                                persistent_workers=persistent_workers and workers > 0,
                                                 drop_last=False)
     logger.info(f"Number of images and batches in source loader: #img = {len(source_dataset)} #batches = {len(source_loader)}")
     return source_dataset, source_loader
 
 
+class SourcePrefetcher:
+    """
+    Endless iterator over a source loader which copies the next batch to the device
+    on a side CUDA stream, while the current step is still being computed.
+    The loader should be created with pin_memory=True, otherwise the copy cannot overlap.
+    """
+    def __init__(self, loader: torch.utils.data.DataLoader, device: str):
+        self.loader = loader
+        self.device = device
+        self.loader_iter = iter(self.loader)
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+        self.next_imgs, self.next_labels = None, None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.loader_iter = iter(self.loader)
+            batch = next(self.loader_iter)
+
+        if self.stream is None:
+            self.next_imgs, self.next_labels = batch[0].to(self.device), batch[1].to(self.device).long()
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_imgs = batch[0].to(self.device, non_blocking=True)
+                self.next_labels = batch[1].to(self.device, non_blocking=True).long()
+
+    def next(self):
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            # the tensors were allocated on the side stream and are now used on the current one
+            self.next_imgs.record_stream(current_stream)
+            self.next_labels.record_stream(current_stream)
+        imgs, labels = self.next_imgs, self.next_labels
+        self.preload()
+        return imgs, labels
+
+
 def sort_by_dirichlet(delta_dirichlet: float, samples: list):
     """
     Adapted from: https://github.com/TaesikGong/NOTE/blob/main/learner/dnn.py
@@ -74,6 +74,12 @@ class TTAMethod(nn.Module):
         # setup for mixed-precision or single precision
         self.mixed_precision = cfg.MIXED_PRECISION
         self.scaler = torch.cuda.amp.GradScaler() if cfg.MIXED_PRECISION else None
+        # autocast dtype for methods supporting bf16. It keeps the dynamic range of fp32, hence loss scaling
+        # is only required for the fp16 fallback on older GPUs
+        self.amp_dtype = torch.bfloat16 if self.device == "cuda" and torch.cuda.is_bf16_supported() else torch.float16
+
+        # identity matrices used as masks, e.g., by contrastive losses
+        self.eye_cache = {}
 
     def forward(self, x, y=None):
         if self.episodic:
@@ -277,6 +283,33 @@ class TTAMethod(nn.Module):
             model.load_state_dict(model_state, strict=True)
         self.optimizer.load_state_dict(self.optimizer_state)
 
+    def get_eye(self, n, m=None):
+        """Return a cached (n x m) identity matrix on the device, since the batch size rarely changes"""
+        m = n if m is None else m
+        if (n, m) not in self.eye_cache:
+            self.eye_cache[(n, m)] = torch.eye(n, m, dtype=torch.float32, device=self.device)
+        return self.eye_cache[(n, m)]
+
+    @staticmethod
+    def capture_cuda_graph(fn, *static_inputs):
+        """
+        Capture fn applied to the static inputs as a CUDA graph. Before the capture, a few warm-up iterations
+        are run on a side stream, as required by CUDA graphs. Returns the graph and its static outputs,
+        which are overwritten by every replay
+        """
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                fn(*static_inputs)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        # only check this thread, since e.g. data loader pin memory threads may call into CUDA during the capture
+        with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+            static_outputs = fn(*static_inputs)
+        return graph, static_outputs
+
     @staticmethod
     def copy_model(model):
         if isinstance(
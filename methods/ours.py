@@ -1,5 +1,6 @@
 import logging
 from copy import deepcopy
+from functools import partial
 
 import torch
 import torch.nn as nn
@@ -59,6 +60,10 @@ class Ours(TTAMethod):
         self.final_lr = cfg.OPTIM.LR
         arch_name = cfg.MODEL.ARCH
         self.arch_name = arch_name
+        self.batch_aug_views = cfg.BATCH_AUG_VIEWS
+
+        # the adaptation step always runs under autocast on the GPU, so the fp16 fallback always needs a scaler
+        self.scaler = torch.cuda.amp.GradScaler() if self.device == "cuda" and self.amp_dtype == torch.float16 else None
 
 
 
@@ -109,7 +114,7 @@ class Ours(TTAMethod):
         _ = self.get_number_trainable_params(self.params_t1, self.model_t1)
 
         # split up the T1 model
-        self.backbone_t1, _ = split_up_model(
+        self.backbone_t1, self.classifier_t1 = split_up_model(
             self.model_t1, self.arch_name, self.dataset_name
         )
         self.optimizer_backbone_t1 = self.setup_optimizer(
@@ -131,7 +136,7 @@ class Ours(TTAMethod):
         _ = self.get_number_trainable_params(self.params_t2, self.model_t2)
 
         # split up the T2 model and setup optimizers
-        self.backbone_t2, _ = split_up_model(
+        self.backbone_t2, self.classifier_t2 = split_up_model(
             self.model_t2, self.arch_name, self.dataset_name
         )
         self.optimizer_backbone_t2 = self.setup_optimizer(
@@ -201,6 +206,35 @@ class Ours(TTAMethod):
             self.model_s, self.arch_name, self.dataset_name
         )
 
+        # side streams to run the forward passes of the independent models concurrently
+        self.streams = (
+            [torch.cuda.Stream() for _ in range(3)] if self.device == "cuda" else None
+        )
+        self.aug_stream = torch.cuda.Stream() if self.device == "cuda" else None
+
+        # variables needed to replay the forward of the T1 model as a captured CUDA graph
+        self.use_cuda_graph = cfg.CUDA_GRAPH and self.device == "cuda"
+        self.t1_graph = None
+        self.static_x = None
+        self.static_features_t1 = None
+        self.static_outputs_t1 = None
+
+        # compile the forward passes of the sub-models used during adaptation in-place, which keeps their
+        # parameter names and state dicts unchanged (needed for the stochastic restore). The full teacher
+        # models are only used for the sliding window and share their layers with the split up models.
+        # the batch size varies (batched views, last batch), hence it is not specialized on
+        if cfg.COMPILE:
+            for module in [
+                self.model_s,
+                self.backbone_t1,
+                self.backbone_t2,
+                self.classifier_t1,
+                self.classifier_t2,
+            ]:
+                module.compile(dynamic=None)
+            # compile the projection together with the normalization, so both are fused into one graph
+            self.project = torch.compile(self.project, dynamic=None)
+
     def prototype_updates(
         self, pqs, num_classes, features, entropies, labels, selected_feature_id
     ):
@@ -245,7 +279,7 @@ class Ours(TTAMethod):
                 selected_entropies = class_entropies[min_entropy_indices]
 
                 # Add selected features and entropies to the priority queue
-                for feature, entropy in zip(selected_features, selected_entropies):
+                for feature, entropy in zip(selected_features, selected_entropies.tolist()):
                     pqs[class_label].add(feature, entropy)
 
         # pop the minimum element from the priority queues every 5 batches
@@ -257,11 +291,93 @@ class Ours(TTAMethod):
             pqs,
             num_classes,
             feature_dim=features.shape[1],
-            device="cuda",
+            device=self.device,
         )
 
         return prototypes
 
+    @staticmethod
+    def forward_split(backbone, classifier, x):
+        """
+        Forward the input through a split up model.
+
+        Args:
+            backbone (nn.Module): Feature extractor of the model
+            classifier (nn.Module): Classifier of the model
+            x (Tensor): Input data for the current batch
+
+        Returns:
+            Tensor: Extracted features
+            Tensor: Model predictions
+        """
+        features = backbone(x)
+        return features, classifier(features)
+
+    @torch.no_grad()
+    def forward_t1_graphed(self, x):
+        """
+        Forward the input through the T1 model, which only provides targets and is never optimized.
+        For a static input shape, the forward is captured once as a CUDA graph and replayed afterwards.
+        T1 is only updated in-place by the EMA, hence the replay always uses the current weights.
+
+        Args:
+            x (Tensor): Input data for the current batch
+
+        Returns:
+            Tensor: Extracted features of T1
+            Tensor: Predictions of T1
+        """
+        if not self.use_cuda_graph or (
+            self.static_x is not None and x.shape != self.static_x.shape
+        ):
+            return self.forward_split(self.backbone_t1, self.classifier_t1, x)
+
+        if self.t1_graph is None:
+            self.static_x = x.clone()
+            # the autocast weight cache is disabled, otherwise the graph would replay stale casts of the weights
+            with torch.autocast("cuda", dtype=self.amp_dtype, cache_enabled=False):
+                self.t1_graph, (self.static_features_t1, self.static_outputs_t1) = (
+                    self.capture_cuda_graph(
+                        partial(self.forward_split, self.backbone_t1, self.classifier_t1),
+                        self.static_x,
+                    )
+                )
+
+        self.static_x.copy_(x)
+        self.t1_graph.replay()
+        return self.static_features_t1.clone(), self.static_outputs_t1.clone()
+
+    def forward_in_streams(self, models, inputs, input_streams=None):
+        """
+        Forward the inputs through independent models, each in its own CUDA stream.
+
+        Args:
+            models (list): Models (or callables) to forward the inputs through
+            inputs (list): Input data of each model
+            input_streams (list): Side stream each input is produced on, None if produced on the current stream
+
+        Returns:
+            list: Outputs of the models
+        """
+        if self.streams is None:
+            return [model(x) for model, x in zip(models, inputs)]
+
+        current_stream = torch.cuda.current_stream()
+        input_streams = input_streams if input_streams is not None else [None] * len(models)
+        outputs = []
+        for model, x, input_stream, stream in zip(
+            models, inputs, input_streams, self.streams
+        ):
+            # wait until the input is produced
+            stream.wait_stream(current_stream)
+            if input_stream is not None:
+                stream.wait_stream(input_stream)
+            with torch.cuda.stream(stream):
+                outputs.append(model(x))
+        for stream in self.streams[: len(models)]:
+            current_stream.wait_stream(stream)
+        return outputs
+
     def is_pqs_full(self):
         """
         Check if the priority queues are full.
@@ -290,33 +406,55 @@ class Ours(TTAMethod):
         #new
         
         x = xx[0]
-        x_aug = self.tta_transform(x)
-        x_aug_soft = self.tta_transform_soft(x)
-
-        outputs_s = self.model_s(x)
-        outputs_t1 = self.model_t1(x)
-        outputs_t2 = self.model_t2(x)
-        outputs_stu_aug = self.model_s(x_aug)
+        if self.aug_stream is not None:
+            # augment on a side stream, overlapping with the forward passes of the original test data
+            self.aug_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.aug_stream):
+                x_aug = self.tta_transform(x)
+                x_aug_soft = self.tta_transform_soft(x)
+                x_cat = torch.cat([x, x_aug], dim=0) if self.batch_aug_views else None
+        else:
+            x_aug = self.tta_transform(x)
+            x_aug_soft = self.tta_transform_soft(x)
+            x_cat = torch.cat([x, x_aug], dim=0) if self.batch_aug_views else None
+
+        # the teacher features are reused below, hence forward the backbones and classifiers separately
+        forward_t2 = partial(self.forward_split, self.backbone_t2, self.classifier_t2)
+        if self.batch_aug_views:
+            # the student and T2 forward the original and augmented test data in a single batched pass, while
+            # T1 only needs the original test data and overlaps with the augmentation
+            outputs_s_cat, (features_t1, outputs_t1), (features_t2_cat, outputs_t2_cat) = (
+                self.forward_in_streams(
+                    [self.model_s, self.forward_t1_graphed, forward_t2],
+                    [x_cat, x, x_cat],
+                    input_streams=[self.aug_stream, None, self.aug_stream],
+                )
+            )
+            if self.aug_stream is not None:
+                torch.cuda.current_stream().wait_stream(self.aug_stream)
+            outputs_s, outputs_stu_aug = outputs_s_cat.chunk(2, dim=0)
+            features_t2, features_aug_t2 = features_t2_cat.chunk(2, dim=0)
+            outputs_t2 = outputs_t2_cat[: x.shape[0]]
+        else:
+            outputs_s, (features_t1, outputs_t1), (features_t2, outputs_t2) = (
+                self.forward_in_streams(
+                    [self.model_s, self.forward_t1_graphed, forward_t2], [x, x, x]
+                )
+            )
+            if self.aug_stream is not None:
+                torch.cuda.current_stream().wait_stream(self.aug_stream)
+            outputs_stu_aug = self.model_s(x_aug)
+            features_aug_t2 = self.backbone_t2(x_aug)
         outputs_stu_aug_simple =self.model_s(x_aug_soft)
 
-        comb_t1_t2 = torch.nn.functional.softmax(outputs_t1 + outputs_t2, dim=1)
-        comb_t1_t2_stu = torch.nn.functional.softmax(
-            outputs_t1 + outputs_t2 + outputs_s, dim=1
-        )
-        comb_t1_s = torch.nn.functional.softmax(outputs_t1 + outputs_s, dim=1)
-        comb_t2_s = torch.nn.functional.softmax(outputs_t2 + outputs_s, dim=1)
-
-        logits_t1 = torch.nn.functional.softmax(outputs_t1, dim=1)
-        logits_t2 = torch.nn.functional.softmax(outputs_t2, dim=1)
-        logits_s = torch.nn.functional.softmax(outputs_s, dim=1)
-
-        correct_t1 = torch.argmax(logits_t1, dim=1) == y
-        correct_t2 = torch.argmax(logits_t2, dim=1) == y
-        correct_s = torch.argmax(logits_s, dim=1) == y
-        correct_comb_t1_t2 = torch.argmax(comb_t1_t2, dim=1) == y
-        correct_comb_t1_t2_stu = torch.argmax(comb_t1_t2_stu, dim=1) == y
-        correct_comb_t1_s = torch.argmax(comb_t1_s, dim=1) == y
-        correct_comb_t2_s = torch.argmax(comb_t2_s, dim=1) == y
+        # the softmax is monotonic, hence the predictions are the argmax of the (summed) logits
+        correct_t1 = torch.argmax(outputs_t1, dim=1) == y
+        correct_t2 = torch.argmax(outputs_t2, dim=1) == y
+        correct_s = torch.argmax(outputs_s, dim=1) == y
+        correct_comb_t1_t2 = torch.argmax(outputs_t1 + outputs_t2, dim=1) == y
+        correct_comb_t1_t2_stu = torch.argmax(outputs_t1 + outputs_t2 + outputs_s, dim=1) == y
+        correct_comb_t1_s = torch.argmax(outputs_t1 + outputs_s, dim=1) == y
+        correct_comb_t2_s = torch.argmax(outputs_t2 + outputs_s, dim=1) == y
 
         total_correct_t1 = correct_t1.sum()
         total_correct_t2 = correct_t2.sum()
@@ -374,9 +512,13 @@ class Ours(TTAMethod):
         
 
         # student model loss
+        # the log_softmax of T1 is shared by both of its symmetric cross entropies
+        log_p_t1 = outputs_t1.detach().log_softmax(1)
         loss_self_training = 0.0
         if "ce_s_t1" in self.cfg.Ours.LOSSES:
-            loss_ce_s_t1 = self.symmetric_cross_entropy(outputs_s, outputs_t1.detach())
+            loss_ce_s_t1 = self.symmetric_cross_entropy(
+                outputs_s, outputs_t1.detach(), log_p_ema=log_p_t1
+            )
             loss_self_training += 0.5 * loss_ce_s_t1
             wandb.log({"ce_s_t1": loss_ce_s_t1.mean(0)})
         if "ce_s_t2" in self.cfg.Ours.LOSSES:
@@ -385,7 +527,7 @@ class Ours(TTAMethod):
             wandb.log({"ce_s_t2": loss_ce_s_t2.mean(0)})
         if "ce_s_aug_t1" in self.cfg.Ours.LOSSES:
             loss_ce_s_aug_t1 = self.symmetric_cross_entropy(
-                outputs_stu_aug, outputs_t1.detach()
+                outputs_stu_aug, outputs_t1.detach(), log_p_ema=log_p_t1
             )
             loss_self_training += 0.5 * loss_ce_s_aug_t1
             wandb.log({"ce_s_aug_t1": loss_ce_s_aug_t1.mean(0)})
@@ -403,7 +545,6 @@ class Ours(TTAMethod):
         selected_filter_ids = filter_ids_2
 
         # select prototypes from T1 model
-        features_t1 = self.backbone_t1(x)
         labels_t1 = torch.argmax(outputs_t1, dim=1)
 
         prototypes = self.prototype_updates(
@@ -423,8 +564,6 @@ class Ours(TTAMethod):
             plot_random_images(x_aug_soft,"b.png", indices)
 
         # calculate the loss for the T2 model
-        features_t2 = self.backbone_t2(x)
-        features_aug_t2 = self.backbone_t2(x_aug)
         cntrs_t2_proto = self.contrastive_loss_proto(
             features_t2, prototypes.detach(), labels_t1, margin=0.5
         )
@@ -483,24 +622,22 @@ class Ours(TTAMethod):
         Returns:
             Tensor: Model predictions
         """
-        if self.mixed_precision and self.device == "cuda":
-            with torch.cuda.amp.autocast():
-                outputs, loss, _ = self.loss_calculation(x)
+        with torch.autocast("cuda", dtype=self.amp_dtype, enabled=self.device == "cuda"):
+            outputs, loss_stu, loss_t2 = self.loss_calculation(x, y)
+
+        # the student and T2 parameters do not overlap, hence a single backward pass suffices
+        loss = loss_stu + loss_t2
+        if self.scaler is not None:
             self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
+            self.scaler.step(self.optimizer_s)
+            self.scaler.step(self.optimizer_backbone_t2)
             self.scaler.update()
-            self.optimizer.zero_grad()
         else:
-            with torch.amp.autocast("cuda"):
-                outputs, loss_stu, loss_t2 = self.loss_calculation(x, y)
-
-                self.optimizer_s.zero_grad()
-                loss_stu.backward()
-                self.optimizer_s.step()
-
-                self.optimizer_backbone_t2.zero_grad()
-                loss_t2.backward()
-                self.optimizer_backbone_t2.step()
+            loss.backward()
+            self.optimizer_s.step()
+            self.optimizer_backbone_t2.step()
+        self.optimizer_s.zero_grad(set_to_none=True)
+        self.optimizer_backbone_t2.zero_grad(set_to_none=True)
 
         self.model_t1 = ema_update_model(
             model_to_update=self.model_t1,
@@ -525,9 +662,10 @@ class Ours(TTAMethod):
                 for nm, m in self.model_t2.named_modules():
                     for npp, p in m.named_parameters():
                         if npp in ["weight", "bias"] and p.requires_grad:
+                            # sample the mask on the device, instead of copying a host tensor per parameter
                             mask = (
-                                (torch.rand(p.shape) < self.rst).float().to(self.device)
-                            )
+                                torch.rand(p.shape, device=self.device) < self.rst
+                            ).float()
                             p.data = self.model_states[0][f"{nm}.{npp}"] * mask + p * (
                                 1.0 - mask
                             )
@@ -588,8 +726,27 @@ class Ours(TTAMethod):
                 m.requires_grad_(False if bn else True)
 
     def copy_model_and_optimizer(self):
-        """Copy the model and optimizer states for resetting after adaptation."""
-        model_states = [deepcopy(model.state_dict()) for model in self.models]
+        """
+        Copy the model and optimizer states for resetting after adaptation.
+        The tensors of a model state are copied into one flat buffer per dtype and device,
+        the returned model states map the parameter and buffer names to views into these buffers.
+        """
+        model_states = []
+        for model in self.models:
+            state = model.state_dict()
+            groups = {}
+            for name, tensor in state.items():
+                groups.setdefault((tensor.dtype, tensor.device), []).append(name)
+
+            model_state = {}
+            for names in groups.values():
+                tensors = [state[name] for name in names]
+                flat = torch._utils._flatten_dense_tensors(tensors)
+                model_state.update(
+                    zip(names, torch._utils._unflatten_dense_tensors(flat, tensors))
+                )
+            model_states.append({name: model_state[name] for name in state})
+
         optimizer_states = [
             deepcopy(optimizer.state_dict()) for optimizer in self.optimizers
         ]
@@ -598,7 +755,11 @@ class Ours(TTAMethod):
     def load_model_and_optimizer(self):
         """Restore the model and optimizer states from copies."""
         for model, model_state in zip(self.models, self.model_states):
-            model.load_state_dict(model_state, strict=True)
+            state = model.state_dict()
+            # restore all tensors with a single multi-tensor copy instead of one copy per tensor
+            torch._foreach_copy_(
+                [state[name] for name in model_state], list(model_state.values())
+            )
         for optimizer, optimizer_state in zip(self.optimizers, self.optimizer_states):
             optimizer.load_state_dict(optimizer_state)
 
@@ -614,11 +775,10 @@ class Ours(TTAMethod):
         Returns:
             Tensor: KL divergence loss
         """
-        prototypes = prototypes[labels]
-        prob1 = F.softmax(features, dim=1)
-        prob2 = F.softmax(prototypes, dim=1)
+        log_prob1 = F.log_softmax(features, dim=1)
+        log_prob2 = F.log_softmax(prototypes[labels], dim=1)
 
-        return F.kl_div(prob1.log(), prob2, reduction="batchmean")
+        return F.kl_div(log_prob1, log_prob2, reduction="batchmean", log_target=True)
 
     def contrastive_loss_proto(self, feature, prototypes, labels, margin=0.5):
         """
@@ -641,23 +801,29 @@ class Ours(TTAMethod):
         cosine_sim = torch.matmul(feature, prototypes.T)
 
         # get the positive similarities (correct class)
-        pos_sim = cosine_sim[torch.arange(cosine_sim.size(0)), labels]
-
-        # mask to ignore the correct class in negative similarities
-        mask = torch.ones_like(cosine_sim, dtype=bool)
-        mask[torch.arange(cosine_sim.size(0)), labels] = False
+        pos_sim = cosine_sim.gather(1, labels.view(-1, 1))
 
-        # compute the loss
-        loss = 0.0
-        for i in range(cosine_sim.size(0)):
-            neg_sim = cosine_sim[i][mask[i]]
-            losses = F.relu(margin - pos_sim[i] + neg_sim)
-            loss += losses.mean()
+        # mask of the correct class, which is ignored in the negative similarities
+        pos_mask = F.one_hot(labels, num_classes=cosine_sim.size(1)).bool()
 
-        loss /= cosine_sim.size(0)
+        # compute the loss for all samples and negatives at once and average over the negatives
+        losses = F.relu(margin - pos_sim + cosine_sim).masked_fill(pos_mask, 0.0)
+        loss = (losses.sum(dim=1) / (cosine_sim.size(1) - 1)).mean()
 
         return loss
 
+    def project(self, features):
+        """
+        Project the features for the contrastive loss and normalize them.
+
+        Args:
+            features (Tensor): Features to project
+
+        Returns:
+            Tensor: Normalized projected features
+        """
+        return F.normalize(self.projector(features), p=2, dim=1)
+
     def contrastive_loss(
         self, features, prototypes, features_aug, labels=None, mask=None
     ):
@@ -674,18 +840,18 @@ class Ours(TTAMethod):
         Returns:
             Tensor: Contrastive loss
         """
-        prototypes = prototypes.unsqueeze(1)
-        with torch.no_grad():
-            x1 = prototypes.repeat(1, features.shape[0], 1)
-            x2 = features.view(1, features.shape[0], features.shape[1]).repeat(
-                prototypes.shape[0], 1, 1
+        # compute the similarities in fp32, since rounding them to half precision ties close prototypes
+        with torch.no_grad(), torch.autocast("cuda", enabled=False):
+            # dist[:, i] contains the cosine similarity from every prototype to one test sample
+            dist = torch.matmul(
+                F.normalize(prototypes.float(), p=2, dim=1),
+                F.normalize(features.float(), p=2, dim=1).T,
             )
-            dist = F.cosine_similarity(x1, x2, dim=-1)
 
             # get the indices of the nearest prototypes
-            _, indices = dist.topk(1, largest=True, dim=0)
-            indices = indices.squeeze(0)
+            indices = dist.argmax(dim=0)
 
+        prototypes = prototypes.unsqueeze(1)
         features = torch.cat(
             [
                 prototypes[indices],
@@ -699,19 +865,18 @@ class Ours(TTAMethod):
         if labels is not None and mask is not None:
             raise ValueError("Cannot define both `labels` and `mask`")
         elif labels is None and mask is None:
-            mask = torch.eye(batch_size, dtype=torch.float32).to(self.device)
+            mask = self.get_eye(batch_size)
         elif labels is not None:
             labels = labels.contiguous().view(-1, 1)
             if labels.shape[0] != batch_size:
                 raise ValueError("Num of labels does not match num of features")
-            mask = torch.eq(labels, labels.T).float().to(self.device)
+            mask = torch.eq(labels, labels.T).float()
         else:
             mask = mask.float().to(self.device)
 
         contrast_count = features.shape[1]
         contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
-        contrast_feature = self.projector(contrast_feature)
-        contrast_feature = F.normalize(contrast_feature, p=2, dim=1)
+        contrast_feature = self.project(contrast_feature)
         if self.contrast_mode == "one":
             anchor_feature = features[:, 0]
             anchor_count = 1
@@ -721,35 +886,30 @@ class Ours(TTAMethod):
         else:
             raise ValueError("Unknown mode: {}".format(self.contrast_mode))
 
-        # compute logits
-        anchor_dot_contrast = torch.div(
-            torch.matmul(anchor_feature, contrast_feature.T), self.temperature
+        # compute logits (in fp32, to keep the precision of the following log-sum-exp under autocast)
+        logits = torch.div(
+            torch.matmul(anchor_feature, contrast_feature.T).float(), self.temperature
         )
 
-        # for numerical stability
-        logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
-        logits = anchor_dot_contrast - logits_max.detach()
-
-        # tile mask
-        mask = mask.repeat(anchor_count, contrast_count)
-
         # mask-out self-contrast cases
-        logits_mask = torch.scatter(
-            torch.ones_like(mask),
-            1,
-            torch.arange(batch_size * anchor_count).view(-1, 1).to(self.device),
-            0,
+        logits_mask = 1 - self.get_eye(
+            batch_size * anchor_count, batch_size * contrast_count
         )
 
-        mask = mask * logits_mask
+        # tile mask by broadcasting it over the anchor and contrast blocks, instead of materializing the repeat
+        mask = (
+            mask.view(1, batch_size, 1, batch_size)
+            * logits_mask.view(anchor_count, batch_size, contrast_count, batch_size)
+        ).view_as(logits_mask)
 
-        # compute log_prob
-        exp_logits = torch.exp(logits) * logits_mask
-
-        log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
+        # compute log_prob as a log_softmax over the non-self-contrast cases. The self-contrast cases are
+        # only excluded from the logsumexp, since a -inf log_prob would turn the masked product into nan
+        log_prob = logits - torch.logsumexp(
+            logits.masked_fill(logits_mask == 0, float("-inf")), dim=1, keepdim=True
+        )
 
         # compute mean of log-likelihood over positive
-        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
+        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1).clamp_min(1)
 
         # loss
         loss = -(self.temperature / self.base_temperature) * mean_log_prob_pos
@@ -10,10 +10,9 @@ import torch.nn.functional as F
 from methods.base import TTAMethod
 from models.model import split_up_model
 from augmentations.transforms_cotta import get_tta_transforms
-from datasets.data_loading import get_source_loader
+from datasets.data_loading import get_source_loader, SourcePrefetcher
 from utils.registry import ADAPTATION_REGISTRY
 from utils.losses import SymmetricCrossEntropy
-from utils.misc import ema_update_model
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +22,10 @@ class RMT(TTAMethod):
     def __init__(self, cfg, model, num_classes):
         super().__init__(cfg, model, num_classes)
 
+        # mixed precision autocasts to amp_dtype, which only needs loss scaling for fp16
+        if self.amp_dtype == torch.bfloat16 or self.device != "cuda":
+            self.scaler = None
+
         batch_size_src = cfg.TEST.BATCH_SIZE if cfg.TEST.BATCH_SIZE > 1 else cfg.TEST.WINDOW_LENGTH
         _, self.src_loader = get_source_loader(dataset_name=cfg.CORRUPTION.DATASET,
                                                adaptation=cfg.MODEL.ADAPTATION,
@@ -33,12 +36,14 @@ class RMT(TTAMethod):
                                                num_samples=cfg.SOURCE.NUM_SAMPLES,
                                                percentage=cfg.SOURCE.PERCENTAGE,
                                                use_clip=cfg.MODEL.USE_CLIP,
-                                               workers=min(cfg.SOURCE.NUM_WORKERS, os.cpu_count()))
-        self.src_loader_iter = iter(self.src_loader)
+                                               workers=min(cfg.SOURCE.NUM_WORKERS, os.cpu_count()),
+                                               pin_memory=True,
+                                               persistent_workers=True)
         self.contrast_mode = cfg.CONTRAST.MODE
         self.temperature = cfg.CONTRAST.TEMPERATURE
         self.base_temperature = self.temperature
         self.projection_dim = cfg.CONTRAST.PROJECTION_DIM
+        self.batch_aug_views = cfg.BATCH_AUG_VIEWS
         self.lambda_ce_src = cfg.RMT.LAMBDA_CE_SRC
         self.lambda_ce_trg = cfg.RMT.LAMBDA_CE_TRG
         self.lambda_cont = cfg.RMT.LAMBDA_CONT
@@ -62,6 +67,11 @@ class RMT(TTAMethod):
         # split up the model
         self.feature_extractor, self.classifier = split_up_model(self.model, arch_name, self.dataset_name)
 
+        # cache the matching parameter lists once, so the ema update does not walk the modules every step
+        param_pairs = list(zip(self.model_ema.parameters(), self.model.parameters()))
+        self.ema_params = [param_ema for param_ema, _ in param_pairs]
+        self.model_params = [param for _, param in param_pairs]
+
         # define the prototype paths
         proto_dir_path = os.path.join(cfg.CKPT_DIR, "prototypes")
         if self.dataset_name == "domainnet126":
@@ -76,28 +86,47 @@ class RMT(TTAMethod):
             self.prototypes_src = torch.load(fname)
         else:
             os.makedirs(proto_dir_path, exist_ok=True)
-            features_src = torch.tensor([])
-            labels_src = torch.tensor([])
+            features_src, labels_src = None, None
+            num_features = 0
             logger.info("Extracting source prototypes...")
             with torch.no_grad():
                 for data in tqdm.tqdm(self.src_loader):
                     x, y = data[0], data[1]
-                    tmp_features = self.feature_extractor(x.to(self.device))
-                    features_src = torch.cat([features_src, tmp_features.view(tmp_features.shape[:2]).cpu()], dim=0)
-                    labels_src = torch.cat([labels_src, y], dim=0)
-                    if len(features_src) > 100000:
+                    tmp_features = self.feature_extractor(x.to(self.device, non_blocking=True))
+                    tmp_features = tmp_features.view(tmp_features.shape[:2])
+                    if features_src is None:
+                        # preallocate the features once: the loop stops with the first batch exceeding 100000 samples.
+                        # This keeps the allocation pattern stable, hence there is no need to empty the cuda cache
+                        num_total = min(len(self.src_loader.dataset), 100000 + self.src_loader.batch_size)
+                        features_src = torch.empty(num_total, tmp_features.shape[1], device=self.device)
+                        labels_src = torch.empty(num_total, dtype=torch.long, device=self.device)
+                    num_features_new = num_features + tmp_features.shape[0]
+                    features_src[num_features:num_features_new].copy_(tmp_features)
+                    labels_src[num_features:num_features_new].copy_(y, non_blocking=True)
+                    num_features = num_features_new
+                    if num_features > 100000:
                         break
+                features_src, labels_src = features_src[:num_features], labels_src[:num_features]
 
-            # create class-wise source prototypes
-            self.prototypes_src = torch.tensor([])
-            for i in range(self.num_classes):
-                mask = labels_src == i
-                self.prototypes_src = torch.cat([self.prototypes_src, features_src[mask].mean(dim=0, keepdim=True)], dim=0)
+                # create class-wise source prototypes with a single pass over the features
+                sums = torch.zeros(self.num_classes, features_src.shape[1], device=self.device)
+                counts = torch.zeros(self.num_classes, device=self.device)
+                sums.index_add_(0, labels_src, features_src)
+                counts.index_add_(0, labels_src, torch.ones_like(labels_src, dtype=torch.float))
+                self.prototypes_src = (sums / counts.unsqueeze(1).clamp_min(1)).cpu()
 
             torch.save(self.prototypes_src, fname)
 
-        self.prototypes_src = self.prototypes_src.to(self.device).unsqueeze(1)
-        self.prototype_labels_src = torch.arange(start=0, end=self.num_classes, step=1).to(self.device).long()
+        self.prototypes_src = self.prototypes_src.to(self.device)  # [num_classes, dim]
+        self.prototypes_norm = F.normalize(self.prototypes_src, p=2, dim=1)
+
+        # preallocated buffer holding the (prototype, test, augmented test) features for the contrastive loss.
+        # The [views, batch, dim] layout allows to flatten the views without a copy
+        self.features_buffer = torch.empty(3, batch_size_src, self.prototypes_src.shape[-1], device=self.device)
+        self.prototype_labels_src = torch.arange(start=0, end=self.num_classes, step=1, dtype=torch.long, device=self.device)
+
+        # prefetch source batches, so their host-to-device copy overlaps with the current adaptation step
+        self.src_prefetcher = SourcePrefetcher(self.src_loader, self.device)
 
         # setup projector
         if self.dataset_name == "domainnet126":
@@ -109,6 +138,11 @@ class RMT(TTAMethod):
                                            nn.Linear(self.projection_dim, self.projection_dim)).to(self.device)
             self.optimizer.add_param_group({'params': self.projector.parameters(), 'lr': self.optimizer.param_groups[0]["lr"]})
 
+        # fuse the pointwise ops of the losses; compiling before the warm up amortizes the compilation
+        if cfg.COMPILE:
+            self.symmetric_cross_entropy = torch.compile(self.symmetric_cross_entropy, dynamic=True)
+            self.contrastive_loss = torch.compile(self.contrastive_loss, dynamic=True)
+
         # warm up the mean-teacher framework
         if self.warmup_steps > 0:
             warmup_ckpt_path = os.path.join(cfg.CKPT_DIR, "warmup")
@@ -139,6 +173,12 @@ class RMT(TTAMethod):
         self.models = [self.model, self.model_ema, self.projector]
         self.model_states, self.optimizer_state = self.copy_model_and_optimizer()
 
+        # variables needed to replay the ema forward of the sliding window as a captured CUDA graph
+        self.use_cuda_graph = cfg.CUDA_GRAPH and self.device == "cuda"
+        self.ema_graph = None
+        self.static_imgs = None
+        self.static_outputs_ema = None
+
     @torch.enable_grad()  # ensure grads in possible no grad context for testing
     def warmup(self):
         logger.info(f"Starting warm up...")
@@ -148,55 +188,64 @@ class RMT(TTAMethod):
                 par["lr"] = self.final_lr * (i+1) / self.warmup_steps
 
             # sample source batch
-            try:
-                batch = next(self.src_loader_iter)
-            except StopIteration:
-                self.src_loader_iter = iter(self.src_loader)
-                batch = next(self.src_loader_iter)
-
-            imgs_src = batch[0].to(self.device)
+            imgs_src, _ = self.src_prefetcher.next()
 
             # forward the test data and optimize the model
-            outputs = self.model(imgs_src)
-            outputs_ema = self.model_ema(imgs_src)
-            loss = self.symmetric_cross_entropy(outputs, outputs_ema).mean(0)
-            loss.backward()
-            self.optimizer.step()
-            self.optimizer.zero_grad()
+            with self.autocast():
+                outputs = self.model(imgs_src)
+                outputs_ema = self.model_ema(imgs_src)
+                loss = self.symmetric_cross_entropy(outputs, outputs_ema).mean(0)
+            self.optimizer_step(loss)
 
-            self.model_ema = ema_update_model(
-                model_to_update=self.model_ema,
-                model_to_merge=self.model,
-                momentum=self.m_teacher_momentum,
-                device=self.device,
-                update_all=True
-            )
+            self.update_ema_model()
 
         logger.info(f"Finished warm up...")
         for par in self.optimizer.param_groups:
             par["lr"] = self.final_lr
 
+    @torch.no_grad()
+    def update_ema_model(self):
+        """Update all ema parameters in-place with a single fused kernel over the cached parameter lists"""
+        if self.m_teacher_momentum < 1.0:
+            torch._foreach_lerp_(self.ema_params, self.model_params, 1 - self.m_teacher_momentum)
+
+    def autocast(self):
+        """Return the autocast context, which is only enabled for mixed precision on the GPU"""
+        return torch.autocast("cuda", dtype=self.amp_dtype, enabled=self.mixed_precision and self.device == "cuda")
+
+    def optimizer_step(self, loss):
+        """Backpropagate the loss and update the model. The loss is only scaled when using fp16"""
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            loss.backward()
+            self.optimizer.step()
+        self.optimizer.zero_grad()
+
     # Integrated from: https://github.com/HobbitLong/SupContrast/blob/master/losses.py
+    # note: in contrast to the original implementation, features have the shape [n_views, batch_size, dim]
     def contrastive_loss(self, features, labels=None, mask=None):
-        batch_size = features.shape[0]
+        batch_size = features.shape[1]
         if labels is not None and mask is not None:
             raise ValueError('Cannot define both `labels` and `mask`')
         elif labels is None and mask is None:
-            mask = torch.eye(batch_size, dtype=torch.float32).to(self.device)
+            mask = self.get_eye(batch_size)
         elif labels is not None:
-            labels = labels.contiguous().view(-1, 1)
+            labels = labels.to(self.device, non_blocking=True).contiguous().view(-1, 1)
             if labels.shape[0] != batch_size:
                 raise ValueError('Num of labels does not match num of features')
-            mask = torch.eq(labels, labels.T).float().to(self.device)
+            mask = torch.eq(labels, labels.T).float()
         else:
-            mask = mask.float().to(self.device)
+            mask = mask.to(self.device, dtype=torch.float32, non_blocking=True)
 
-        contrast_count = features.shape[1]
-        contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
+        contrast_count = features.shape[0]
+        contrast_feature = features.reshape(-1, features.shape[-1])
         contrast_feature = self.projector(contrast_feature)
         contrast_feature = F.normalize(contrast_feature, p=2, dim=1)
         if self.contrast_mode == 'one':
-            anchor_feature = features[:, 0]
+            anchor_feature = features[0]
             anchor_count = 1
         elif self.contrast_mode == 'all':
             anchor_feature = contrast_feature
@@ -204,26 +253,17 @@ class RMT(TTAMethod):
         else:
             raise ValueError('Unknown mode: {}'.format(self.contrast_mode))
 
-        # compute logits
-        anchor_dot_contrast = torch.div(torch.matmul(anchor_feature, contrast_feature.T), self.temperature)
-        # for numerical stability
-        logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
-        logits = anchor_dot_contrast - logits_max.detach()
+        # compute logits (in fp32, to keep the precision of the following log-sum-exp under autocast)
+        logits = torch.div(torch.matmul(anchor_feature, contrast_feature.T).float(), self.temperature)
 
         # tile mask
         mask = mask.repeat(anchor_count, contrast_count)
         # mask-out self-contrast cases
-        logits_mask = torch.scatter(
-            torch.ones_like(mask),
-            1,
-            torch.arange(batch_size * anchor_count).view(-1, 1).to(self.device),
-            0
-        )
+        logits_mask = 1 - self.get_eye(batch_size * anchor_count, batch_size * contrast_count)
         mask = mask * logits_mask
 
-        # compute log_prob
-        exp_logits = torch.exp(logits) * logits_mask
-        log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
+        # compute log_prob (logsumexp is numerically stable, no need to subtract the max)
+        log_prob = logits - torch.logsumexp(logits.masked_fill(logits_mask == 0, float('-inf')), dim=1, keepdim=True)
 
         # compute mean of log-likelihood over positive
         mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
@@ -236,31 +276,42 @@ class RMT(TTAMethod):
     def loss_calculation(self, x):
         imgs_test = x[0]
 
-        # forward original test data
-        features_test = self.feature_extractor(imgs_test)
-        outputs_test = self.classifier(features_test)
+        if self.batch_aug_views:
+            # forward original and augmented test data in a single batched pass
+            imgs_cat = torch.cat([imgs_test, self.tta_transform(imgs_test)], dim=0)
+            features_cat = self.feature_extractor(imgs_cat)
+            outputs_cat = self.classifier(features_cat)
+            features_test, features_aug_test = features_cat.chunk(2, dim=0)
+            outputs_test, outputs_aug_test = outputs_cat.chunk(2, dim=0)
+        else:
+            # forward original test data
+            features_test = self.feature_extractor(imgs_test)
+            outputs_test = self.classifier(features_test)
 
-        # forward augmented test data
-        features_aug_test = self.feature_extractor(self.tta_transform(imgs_test))
-        outputs_aug_test = self.classifier(features_aug_test)
+            # forward augmented test data
+            features_aug_test = self.feature_extractor(self.tta_transform(imgs_test))
+            outputs_aug_test = self.classifier(features_aug_test)
 
         # forward original test data through the ema model
         outputs_ema = self.model_ema(imgs_test)
 
-        with torch.no_grad():
-            # dist[:, i] contains the distance from every source sample to one test sample
-            dist = F.cosine_similarity(
-                x1=self.prototypes_src.repeat(1, features_test.shape[0], 1),
-                x2=features_test.view(1, features_test.shape[0], features_test.shape[1]).repeat(self.prototypes_src.shape[0], 1, 1),
-                dim=-1)
+        # compute the similarities in fp32, since rounding them to half precision ties close prototypes
+        with torch.no_grad(), torch.autocast("cuda", enabled=False):
+            # sims[i, :] contains the cosine similarity from one test sample to every source prototype
+            sims = F.normalize(features_test.float(), p=2, dim=1) @ self.prototypes_norm.float().T
 
             # for every test feature, get the nearest source prototype and derive the label
-            _, indices = dist.topk(1, largest=True, dim=0)
-            indices = indices.squeeze(0)
+            indices = sims.argmax(dim=1)
+
+        batch_size = features_test.shape[0]
+        if batch_size > self.features_buffer.shape[1]:
+            self.features_buffer = torch.empty(3, batch_size, features_test.shape[1], device=self.device)
 
-        features = torch.cat([self.prototypes_src[indices],
-                              features_test.view(features_test.shape[0], 1, features_test.shape[1]),
-                              features_aug_test.view(features_test.shape[0], 1, features_test.shape[1])], dim=1)
+        # fill the buffer in-place. Detaching gives a fresh alias, so no autograd history is kept across steps
+        features = self.features_buffer.detach()[:, :batch_size]
+        features[0] = self.prototypes_src[indices]
+        features[1] = features_test
+        features[2] = features_aug_test
         loss_contrastive = self.contrastive_loss(features=features, labels=None)
 
         loss_self_training = (0.5 * self.symmetric_cross_entropy(outputs_test, outputs_ema) + 0.5 * self.symmetric_cross_entropy(outputs_aug_test, outputs_ema)).mean(0)
@@ -268,17 +319,12 @@ class RMT(TTAMethod):
 
         if self.lambda_ce_src > 0:
             # sample source batch
-            try:
-                batch = next(self.src_loader_iter)
-            except StopIteration:
-                self.src_loader_iter = iter(self.src_loader)
-                batch = next(self.src_loader_iter)
+            imgs_src, labels_src = self.src_prefetcher.next()
 
             # train on labeled source data
-            imgs_src, labels_src = batch[0], batch[1]
-            features_src = self.feature_extractor(imgs_src.to(self.device))
+            features_src = self.feature_extractor(imgs_src)
             outputs_src = self.classifier(features_src)
-            loss_ce_src = F.cross_entropy(outputs_src, labels_src.to(self.device).long())
+            loss_ce_src = F.cross_entropy(outputs_src, labels_src)
             loss += self.lambda_ce_src * loss_ce_src
 
         # create and return the ensemble prediction
@@ -287,26 +333,11 @@ class RMT(TTAMethod):
 
     @torch.enable_grad()
     def forward_and_adapt(self, x):
-        if self.mixed_precision and self.device == "cuda":
-            with torch.cuda.amp.autocast():
-                outputs, loss = self.loss_calculation(x)
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
-            self.optimizer.zero_grad()
-        else:
+        with self.autocast():
             outputs, loss = self.loss_calculation(x)
-            loss.backward()
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-
-        self.model_ema = ema_update_model(
-            model_to_update=self.model_ema,
-            model_to_merge=self.model,
-            momentum=self.m_teacher_momentum,
-            device=self.device,
-            update_all=True
-        )
+        self.optimizer_step(loss)
+
+        self.update_ema_model()
         return outputs
 
     @torch.no_grad()
@@ -317,10 +348,31 @@ class RMT(TTAMethod):
         :return: Model predictions
         """
         imgs_test = x[0]
-        outputs_test = self.model(imgs_test)
-        outputs_ema = self.model_ema(imgs_test)
+        with self.autocast():
+            outputs_test = self.model(imgs_test)
+            outputs_ema = self.forward_ema_graphed(imgs_test)
         return outputs_test + outputs_ema
 
+    @torch.no_grad()
+    def forward_ema_graphed(self, imgs_test):
+        """
+        Forward the ema model. Once the sliding window is full, its shape is static and the forward
+        is captured once as a CUDA graph and replayed afterwards. The ema parameters are updated in-place,
+        hence the replay always uses the current weights.
+        :param imgs_test: The buffered test images
+        :return: Predictions of the ema model
+        """
+        if not self.use_cuda_graph or imgs_test.shape[0] != self.window_length:
+            return self.model_ema(imgs_test)
+
+        if self.ema_graph is None:
+            self.static_imgs = imgs_test.clone()
+            self.ema_graph, self.static_outputs_ema = self.capture_cuda_graph(self.model_ema, self.static_imgs)
+
+        self.static_imgs.copy_(imgs_test)
+        self.ema_graph.replay()
+        return self.static_outputs_ema.clone()
+
     def configure_model(self):
         """Configure model"""
         # model.train()
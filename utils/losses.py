@@ -8,7 +8,9 @@ class Entropy(nn.Module):
         super(Entropy, self).__init__()
 
     def __call__(self, logits):
-        return -(logits.softmax(1) * logits.log_softmax(1)).sum(1)
+        # derive the softmax from the log_softmax, instead of normalizing the logits twice
+        log_p = logits.log_softmax(1)
+        return -(log_p.exp() * log_p).sum(1)
 
 
 class SymmetricCrossEntropy(nn.Module):
@@ -16,10 +18,15 @@ class SymmetricCrossEntropy(nn.Module):
         super(SymmetricCrossEntropy, self).__init__()
         self.alpha = alpha
 
-    def __call__(self, x, x_ema):
-        return -(1 - self.alpha) * (x_ema.softmax(1) * x.log_softmax(1)).sum(
+    def __call__(self, x, x_ema, log_p_ema=None):
+        # compute each log_softmax only once and derive the softmax from it. The log_softmax of the
+        # teacher can be passed as log_p_ema, when the same teacher output is used for several losses
+        log_p = x.log_softmax(1)
+        if log_p_ema is None:
+            log_p_ema = x_ema.log_softmax(1)
+        return -(1 - self.alpha) * (log_p_ema.exp() * log_p).sum(
             1
-        ) - self.alpha * (x.softmax(1) * x_ema.log_softmax(1)).sum(1)
+        ) - self.alpha * (log_p.exp() * log_p_ema).sum(1)
 
 
 class AugCrossEntropy(nn.Module):
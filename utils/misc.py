@@ -14,9 +14,14 @@ logger = logging.getLogger(__name__)
 @torch.no_grad()
 def ema_update_model(model_to_update, model_to_merge, momentum, device, update_all=False):
     if momentum < 1.0:
+        params_to_update, params_to_merge = [], []
         for param_to_update, param_to_merge in zip(model_to_update.parameters(), model_to_merge.parameters()):
             if param_to_update.requires_grad or update_all:
-                param_to_update.data = momentum * param_to_update.data + (1 - momentum) * param_to_merge.data.to(device)
+                params_to_update.append(param_to_update.data)
+                params_to_merge.append(param_to_merge.data.to(device))
+        # a single fused multi-tensor kernel instead of a mul + add per parameter
+        if len(params_to_update) > 0:
+            torch._foreach_lerp_(params_to_update, params_to_merge, 1 - momentum)
     return model_to_update
 
 
@@ -70,8 +75,9 @@ def init_pqs(num_classes, max_size):
     return pqs
 
 def update_pqs(pqs, features, entropies, labels):
-    for i in range(features.size(0)):
-        pqs[labels[i].item()].add(features[i], entropies[i])
+    # copy the entropies and labels to the host once, instead of synchronizing for every element and comparison
+    for feature, entropy, label in zip(features, entropies.tolist(), labels.tolist()):
+        pqs[label].add(feature, entropy)
 
 def compute_prototypes(pqs, num_classes, feature_dim, device='cpu'):
     prototypes = []
@@ -82,7 +88,7 @@ def compute_prototypes(pqs, num_classes, feature_dim, device='cpu'):
             entropies = pqs[class_label].get_entropies()
 
             features = torch.stack([feature.to(device) for feature in features])
-            entropies = torch.tensor(entropies).to(device)
+            entropies = torch.tensor(entropies, device=device)
 
             # Add small epsilon to avoid division by zero
             weights = 1/(entropies + 1e-6)
@@ -93,7 +99,7 @@ def compute_prototypes(pqs, num_classes, feature_dim, device='cpu'):
             # Compute the prototype as the weighted sum of the features
             prototype = weighted_features.sum(dim=0) / weights.sum()
         else:
-            prototype = torch.zeros(feature_dim).to(device)
+            prototype = torch.zeros(feature_dim, device=device)
 
         prototypes.append(prototype)
 